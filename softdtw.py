@@ -1,93 +1,330 @@
 import numpy as np
 import torch
 import torch.cuda
-from numba import jit
+from numba import jit, prange
 from torch.autograd import Function
 from numba import cuda
+from numba import float32, float64
+import functools
 import math
 
+# The CUDA kernels split R into square tiles of (at most) this size. One block of TILE_SIZE threads processes one tile,
+# and the tiles are swept along their own anti-diagonals, so the sequence length is not bounded by the block size.
+TILE_SIZE = 32
+WARP_SIZE = 32
+
 
 # ----------------------------------------------------------------------------------------------------------------------
-@cuda.jit
-def compute_softdtw_cuda(D, gamma, bandwidth, max_i, max_j, n_passes, R):
+@functools.lru_cache(maxsize=None)
+def _make_compute_softdtw_cuda(tile, dtype, band):
     """
-    :param seq_len: The length of the sequence (both inputs are assumed to be of the same size)
-    :param n_passes: 2 * seq_len - 1 (The number of anti-diagonals)
+    Builds the forward kernel. The tile size is baked into the kernel as a constant, so the loop bounds are fixed at
+    compile time, and with band=False the band check is compiled out. The sizes of D are passed at launch, so sequences
+    of any length share the same few kernels. The kernel must be launched with blocks of tile threads. A tile of at
+    most WARP_SIZE is processed by a single warp, and the block-wide barriers between anti-diagonals are replaced with
+    the much cheaper warp-level ones.
+    The tiles are staged in shared memory as dtype, which should match R (see _get_shared_dtype()), and the softmin is
+    evaluated in the same precision, so single precision inputs get the single precision exp() / log().
     """
-    # Each block processes one pair of examples
-    b = cuda.blockIdx.x
-    # We have as many threads as seq_len, because the most number of threads we need
-    # is equal to the number of elements on the largest anti-diagonal
-    tid = cuda.threadIdx.x
+    warp = tile <= WARP_SIZE
+    # Threads taking part in the warp-level barriers (a tile can be narrower than a warp)
+    lane_mask = (1 << tile) - 1 if tile < WARP_SIZE else -1
+    pitch = _get_shared_pitch(tile)
 
-    # Compute I, J, the indices from [0, seq_len)
+    @cuda.jit
+    def compute_softdtw_cuda(D, gamma, bandwidth, max_i, max_j, tile_diag, tile_i0, R):
+        """
+        :param tile_diag: The anti-diagonal of tiles processed by this launch
+        :param tile_i0: The tile row of the first tile on that anti-diagonal
+        """
+        # The tile plus its top row / left column of dependencies (computed by earlier launches) lives in shared memory
+        sR = cuda.shared.array(shape=(tile + 1, pitch), dtype=dtype)
+        # The anti-diagonal sweep reads D with a large stride between threads, so the tile of D is staged as well
+        sD = cuda.shared.array(shape=(tile, pitch), dtype=dtype)
+
+        # Each block processes one tile of one pair of examples
+        b = cuda.blockIdx.x
+        ti = tile_i0 + cuda.blockIdx.y
+        tj = tile_diag - ti
+        # We have as many threads as the tile size, because the most number of threads we need
+        # is equal to the number of elements on the largest anti-diagonal of a tile
+        tid = cuda.threadIdx.x
+
+        # Offsets of the tile in R (the tile itself starts at [i0 + 1, j0 + 1])
+        i0 = ti * tile
+        j0 = tj * tile
+
+        # Hoisted out of the anti-diagonal loop, and converted once so that no double precision math is mixed in
+        neg_inv_gamma = dtype(-1.0 / gamma)
+        neg_gamma = dtype(-gamma)
+
+        # Load the dependencies of the tile, and the tile of D.
+        # Consecutive threads always access consecutive columns, so that the global memory accesses are coalesced
+        if j0 + tid + 1 <= max_j + 1:
+            sR[0, tid + 1] = R[b, i0, j0 + tid + 1]
+        if i0 + tid + 1 <= max_i + 1:
+            sR[tid + 1, 0] = R[b, i0 + tid + 1, j0]
+        if tid == 0:
+            sR[0, 0] = R[b, i0, j0]
+        if j0 + tid < max_j:
+            for I in range(min(tile, max_i - i0)):
+                sD[I, tid] = D[b, i0 + I, j0 + tid]
+        if warp:
+            cuda.syncwarp(lane_mask)
+        else:
+            cuda.syncthreads()
+
+        # The row index (within the tile) is always the same as tid
+        I = tid
+        i = i0 + I + 1
+
+        # A tile that fits in a warp keeps the wavefront in registers: a thread's left neighbor is its own result from
+        # the previous anti-diagonal, its upper neighbor is shuffled in from the lane above, and its diagonal neighbor
+        # is the upper neighbor of the previous anti-diagonal. Only the halo of the tile is read from shared memory.
+        if warp:
+            left = sR[I + 1, 0]
+            diag = sR[I, 0]
+
+        # Go over each anti-diagonal of the tile. Only process threads that fall on the current on the anti-diagonal
+        for p in range(2 * tile - 1):
+            J = p - tid
+            j = j0 + J + 1
+
+            # Every lane of the mask has to take part in the shuffle, so it cannot go inside the branch below
+            if warp:
+                up = cuda.shfl_up_sync(lane_mask, left, 1)
+                if tid == 0 and 0 <= J < tile:
+                    up = sR[0, J + 1]
+
+            if 0 <= J < tile:
+                # Kept in dtype, r is carried over into the shuffled registers
+                r = dtype(math.inf)
+                # Only compute if element[i, j] is within bounds
+                if i <= max_i and j <= max_j:
+                    # Don't compute if outside bandwidth
+                    if not band or abs(i - j) <= bandwidth:
+                        if warp:
+                            r0 = diag * neg_inv_gamma
+                            r1 = up * neg_inv_gamma
+                            r2 = left * neg_inv_gamma
+                        else:
+                            r0 = sR[I, J] * neg_inv_gamma
+                            r1 = sR[I, J + 1] * neg_inv_gamma
+                            r2 = sR[I + 1, J] * neg_inv_gamma
+                        # exp(rmax - rmax) == 1, so only the two smaller terms need an exp
+                        rmax = max(max(r0, r1), r2)
+                        rmin = min(min(r0, r1), r2)
+                        rmid = max(min(r0, r1), min(max(r0, r1), r2))
+                        rsum = math.exp(rmid - rmax) + math.exp(rmin - rmax)
+                        softmin = neg_gamma * (math.log1p(rsum) + rmax)
+                        r = sD[I, J] + softmin
+                # Still stored for the write-back below
+                sR[I + 1, J + 1] = r
+                if warp:
+                    diag = up
+                    left = r
+
+            # Wait for other threads in this block (the shuffles already keep a single warp in step)
+            if not warp:
+                cuda.syncthreads()
+        if warp:
+            cuda.syncwarp(lane_mask)
+
+        # Write the tile back (coalesced again), later tiles read their dependencies from it (and the backward pass
+        # needs all of R)
+        if j0 + tid < max_j:
+            for I in range(min(tile, max_i - i0)):
+                R[b, i0 + I + 1, j0 + tid + 1] = sR[I + 1, tid + 1]
+
+    return compute_softdtw_cuda
 
-    # The row index is always the same as tid
-    I = tid
 
-    inv_gamma = 1.0 / gamma
+# ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def _make_compute_softdtw_backward_cuda(tile, dtype, band):
+    """
+    Builds the backward kernel, see _make_compute_softdtw_cuda()
+    """
+    warp = tile <= WARP_SIZE
+    lane_mask = (1 << tile) - 1 if tile < WARP_SIZE else -1
+    pitch = _get_shared_pitch(tile)
+
+    @cuda.jit
+    def compute_softdtw_backward_cuda(D, R, inv_gamma, bandwidth, max_i, max_j, tile_diag, tile_i0, E):
+        # The tile plus its bottom row / right column of dependencies is staged in shared memory.
+        # Unlike the forward pass, the whole tile of R and D is needed, and the last row / column of E and R (set up by
+        # init_softdtw_backward_cuda) may fall inside a tile, so everything up to [max_i + 1, max_j + 1] is loaded.
+        sE = cuda.shared.array(shape=(tile + 1, pitch), dtype=dtype)
+        sR = cuda.shared.array(shape=(tile + 1, pitch), dtype=dtype)
+        sD = cuda.shared.array(shape=(tile + 1, pitch), dtype=dtype)
+
+        k = cuda.blockIdx.x
+        ti = tile_i0 + cuda.blockIdx.y
+        tj = tile_diag - ti
+        tid = cuda.threadIdx.x
+
+        # Offsets of the tile in R (the tile itself starts at [i0 + 1, j0 + 1])
+        i0 = ti * tile
+        j0 = tj * tile
+
+        # Consecutive threads always access consecutive columns, so that the global memory accesses are coalesced
+        for J in range(tid, min(tile + 1, max_j + 1 - j0), tile):
+            j = j0 + J + 1
+            for I in range(min(tile + 1, max_i + 1 - i0)):
+                i = i0 + I + 1
+                r = R[k, i, j]
+                # Cells that were never reached by the forward pass must not contribute
+                if i <= max_i and j <= max_j and math.isinf(r):
+                    r = -math.inf
+                sE[I, J] = E[k, i, j]
+                sR[I, J] = r
+                sD[I, J] = D[k, i, j]
+        if warp:
+            cuda.syncwarp(lane_mask)
+        else:
+            cuda.syncthreads()
+
+        # Indexing logic is the same as above, however, the anti-diagonal needs to
+        # progress backwards
+        I = tid
+        i = i0 + I + 1
+
+        inv_gamma_ = dtype(inv_gamma)
+
+        for p in range(2 * tile - 1):
+            # Reverse the order to make the loop go backward
+            rev_p = 2 * tile - 2 - p
+
+            J = rev_p - tid
+            j = j0 + J + 1
+
+            # Only compute if element[i, j] is on the current anti-diagonal, and also is within bounds
+            if 0 <= J < tile and i <= max_i and j <= max_j:
+                # Don't compute if outside bandwidth
+                if not band or abs(i - j) <= bandwidth:
+                    r = sR[I, J]
+                    a = math.exp((sR[I + 1, J] - r - sD[I + 1, J]) * inv_gamma_)
+                    b = math.exp((sR[I, J + 1] - r - sD[I, J + 1]) * inv_gamma_)
+                    c = math.exp((sR[I + 1, J + 1] - r - sD[I + 1, J + 1]) * inv_gamma_)
+                    sE[I, J] = sE[I + 1, J] * a + sE[I, J + 1] * b + sE[I + 1, J + 1] * c
+
+            # Wait for other threads in this block
+            if warp:
+                cuda.syncwarp(lane_mask)
+            else:
+                cuda.syncthreads()
 
-    # Go over each anti-diagonal. Only process threads that fall on the current on the anti-diagonal
-    for p in range(n_passes):
+        # Write the tile back (coalesced again), earlier tiles read their dependencies from it
+        if j0 + tid < max_j:
+            for I in range(min(tile, max_i - i0)):
+                E[k, i0 + I + 1, j0 + tid + 1] = sE[I, tid]
 
-        # The index is actually 'p - tid' but need to force it in-bounds
-        J = max(0, min(p - tid, max_j - 1))
+    return compute_softdtw_backward_cuda
 
-        # For simplicity, we define i, j which start from 1 (offset from I, J)
-        i = I + 1
-        j = J + 1
 
-        # Only compute if element[i, j] is on the current anti-diagonal, and also is within bounds
-        if I + J == p and (I < max_i and J < max_j):
-            # Don't compute if outside bandwidth
-            if not (abs(i - j) > bandwidth > 0):
-                r0 = -R[b, i - 1, j - 1] * inv_gamma
-                r1 = -R[b, i - 1, j] * inv_gamma
-                r2 = -R[b, i, j - 1] * inv_gamma
-                rmax = max(max(r0, r1), r2)
-                rsum = math.exp(r0 - rmax) + math.exp(r1 - rmax) + math.exp(r2 - rmax)
-                softmin = -gamma * (math.log(rsum) + rmax)
-                R[b, i, j] = D[b, i - 1, j - 1] + softmin
+# ----------------------------------------------------------------------------------------------------------------------
+@cuda.jit
+def init_softdtw_backward_cuda(R, r_end, c_end, E):
+    """
+    Sets up R and E for the backward pass in a single launch, one thread per element of the padded (B, N + 2, M + 2)
+    arrays: row r_end and column c_end of R become -inf except for the seed cell, which copies the forward result
+    diagonally before it, and E is cleared except for a 1 in the seed cell.
+    The seed reads a cell outside row r_end and column c_end, so no thread overwrites it.
+    """
+    idx = cuda.grid(1)
+    n_rows = R.shape[1]
+    n_cols = R.shape[2]
+    if idx >= R.shape[0] * n_rows * n_cols:
+        return
+    b = idx // (n_rows * n_cols)
+    i = (idx // n_cols) % n_rows
+    j = idx % n_cols
+
+    if i == r_end and j == c_end:
+        R[b, i, j] = R[b, i - 1, j - 1]
+        E[b, i, j] = 1
+    else:
+        if i == r_end or j == c_end:
+            R[b, i, j] = -math.inf
+        E[b, i, j] = 0
+
 
-        # Wait for other threads in this block
-        cuda.syncthreads()
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_shared_dtype(dtype):
+    """
+    The numba type the kernels stage R / E / D in. Single precision inputs are staged in single precision, which halves
+    the shared memory traffic and footprint compared to always staging in double precision.
+    """
+    return float64 if dtype == torch.float64 else float32
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-@cuda.jit
-def compute_softdtw_backward_cuda(D, R, inv_gamma, bandwidth, max_i, max_j, n_passes, E):
-    k = cuda.blockIdx.x
-    tid = cuda.threadIdx.x
+def _get_shared_pitch(tile):
+    """
+    The row pitch of the tiles staged in shared memory. The sweeps access a tile along its anti-diagonals, where
+    consecutive threads are pitch - 1 elements apart, so an even pitch (at least tile + 1) spreads the threads of a warp
+    over distinct banks. An odd pitch such as tile + 1 = 33 would put every thread of the warp in the same bank.
+    """
+    return tile + 2 - tile % 2
 
-    # Indexing logic is the same as above, however, the anti-diagonal needs to
-    # progress backwards
-    I = tid
 
-    for p in range(n_passes):
-        # Reverse the order to make the loop go backward
-        rev_p = n_passes - p - 1
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_tile_range(tile_diag, tile, N, M, bandwidth):
+    """
+    Returns the first and last tile row on the given anti-diagonal of tiles. With pruning, the tiles that lie entirely
+    outside the bandwidth are left out: their cells are never computed, so there is no need to launch a block for them.
+    """
+    n_tiles_i = (N + tile - 1) // tile
+    n_tiles_j = (M + tile - 1) // tile
+    tile_i0 = max(0, tile_diag - n_tiles_j + 1)
+    tile_i1 = min(tile_diag, n_tiles_i - 1)
+
+    if bandwidth > 0:
+        # The tiles within the band are contiguous along the anti-diagonal, just trim both ends
+        while tile_i0 <= tile_i1 and _get_tile_distance(tile_i0, tile_diag - tile_i0, tile, N, M) > bandwidth:
+            tile_i0 += 1
+        while tile_i1 >= tile_i0 and _get_tile_distance(tile_i1, tile_diag - tile_i1, tile, N, M) > bandwidth:
+            tile_i1 -= 1
 
-        # convert tid to I, J, then i, j
-        J = max(0, min(rev_p - tid, max_j - 1))
+    return tile_i0, tile_i1
 
-        i = I + 1
-        j = J + 1
 
-        # Only compute if element[i, j] is on the current anti-diagonal, and also is within bounds
-        if I + J == rev_p and (I < max_i and J < max_j):
+def _get_tile_distance(ti, tj, tile, N, M):
+    """
+    Returns the smallest |i - j| over the cells of a tile
+    """
+    i_first, i_last = ti * tile + 1, min((ti + 1) * tile, N)
+    j_first, j_last = tj * tile + 1, min((tj + 1) * tile, M)
+    return max(0, j_first - i_last, i_first - j_last)
 
-            if math.isinf(R[k, i, j]):
-                R[k, i, j] = -math.inf
 
-            # Don't compute if outside bandwidth
-            if not (abs(i - j) > bandwidth > 0):
-                a = math.exp((R[k, i + 1, j] - R[k, i, j] - D[k, i + 1, j]) * inv_gamma)
-                b = math.exp((R[k, i, j + 1] - R[k, i, j] - D[k, i, j + 1]) * inv_gamma)
-                c = math.exp((R[k, i + 1, j + 1] - R[k, i, j] - D[k, i + 1, j + 1]) * inv_gamma)
-                E[k, i, j] = E[k, i + 1, j] * a + E[k, i, j + 1] * b + E[k, i + 1, j + 1] * c
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_stream(dev):
+    """
+    Wraps PyTorch's current stream on the given device for numba. Launching on it orders the kernels after the PyTorch
+    ops that produce their inputs without blocking the host, and lets them overlap with work on other streams, instead
+    of going through the legacy default stream which serializes against every other stream.
+    """
+    # Older numba versions (< 0.53) cannot wrap foreign streams, fall back to the default stream there
+    if not hasattr(cuda, 'external_stream'):
+        return 0
+    return cuda.external_stream(torch.cuda.current_stream(dev).cuda_stream)
 
-        # Wait for other threads in this block
-        cuda.syncthreads()
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_buffer(cache, name, shape, dev, dtype):
+    """
+    Returns an uninitialized buffer of the given shape, or a freshly allocated one when no cache is given. The cache
+    keeps a single flat buffer per name that only ever grows, smaller shapes are views of its front, so the memory held
+    is bounded by the largest problem seen. The caller must (re)initialize the buffer.
+    """
+    if cache is None:
+        return torch.empty(shape, device=dev, dtype=dtype)
+    numel = int(np.prod(shape))
+    buf = cache.get(name)
+    if buf is None or buf.numel() < numel or buf.device != dev or buf.dtype != dtype:
+        buf = cache[name] = torch.empty(numel, device=dev, dtype=dtype)
+    return buf[:numel].view(shape)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -98,121 +335,92 @@ class _SoftDTWCUDA(Function):
     """
 
     @staticmethod
-    def forward(ctx, D, gamma, bandwidth):
+    def forward(ctx, D, gamma, bandwidth, cache=None):
         dev = D.device
         dtype = D.dtype
-        gamma = torch.cuda.FloatTensor([gamma])
-        bandwidth = torch.cuda.FloatTensor([bandwidth])
 
         B = D.shape[0]
         N = D.shape[1]
         M = D.shape[2]
-        threads_per_block = max(N, M)
-        n_passes = 2 * threads_per_block - 1
-
-        # Prepare the output array
-        R = torch.ones((B, N + 2, M + 2), device=dev, dtype=dtype) * math.inf
+        tile = min(TILE_SIZE, max(N, M))
+        n_tile_diags = (N + tile - 1) // tile + (M + tile - 1) // tile - 1
+
+        # Prepare the output array. R is saved for backward when D needs a gradient, so it can only be recycled when it
+        # does not, several forward calls may be pending before a single backward
+        reuse_R = cache is not None and not ctx.needs_input_grad[0]
+        R = _get_buffer(cache if reuse_R else None, 'R', (B, N + 2, M + 2), dev, dtype)
+        R.fill_(math.inf)
         R[:, 0, 0] = 0
 
-        # Run the CUDA kernel.
-        # Set CUDA's grid size to be equal to the batch size (every CUDA block processes one sample pair)
-        # Set the CUDA block size to be equal to the length of the longer sequence (equal to the size of the largest diagonal)
-        compute_softdtw_cuda[B, threads_per_block](cuda.as_cuda_array(D.detach()),
-                                                   gamma.item(), bandwidth.item(), N, M, n_passes,
-                                                   cuda.as_cuda_array(R))
-        ctx.save_for_backward(D, R, gamma, bandwidth)
-
-        l1 = D.shape[1]
-        l2 = D.shape[2]
-        bw = int(bandwidth.item())
-
-        if l1 < l2:
-            if bw >= abs(l1 - l2) or bw == 0:
-                return R[:, -2, -2]
-            else:
-                return R[:, -2, l1 - l2 + int(bandwidth.item()) - 2]
-        elif l1 > l2:
-            if bw >= abs(l1 - l2) or bw == 0:
-                return R[:, -2, -2]
-            else:
-                return R[:, l2 - l1 + int(bandwidth.item()) - 2, -2]
-
-        else:
-            return R[:, -2, -2]
-
-        # return R[:, -2, -2]
-        # return V
+        # Run the CUDA kernel once per anti-diagonal of tiles, the tiles on one anti-diagonal are independent.
+        # Set CUDA's grid size to be (batch size, number of tiles on the anti-diagonal that intersect the band).
+        # The batch goes on the x axis, gridDim.y is limited to 65535
+        # Set the CUDA block size to be equal to the tile size (equal to the size of the largest diagonal of a tile)
+        # The kernels assume a row-major D when they coalesce their loads
+        D_ = cuda.as_cuda_array(D.detach().contiguous())
+        R_ = cuda.as_cuda_array(R)
+        # The kernel is compiled once per tile size, precision and banding, and reused afterwards
+        kernel = _make_compute_softdtw_cuda(tile, _get_shared_dtype(dtype), bandwidth > 0)
+        stream = _get_stream(dev)
+        for tile_diag in range(n_tile_diags):
+            tile_i0, tile_i1 = _get_tile_range(tile_diag, tile, N, M, bandwidth)
+            if tile_i0 > tile_i1:
+                continue
+            kernel[(B, tile_i1 - tile_i0 + 1), tile, stream](D_, gamma, bandwidth, N, M, tile_diag, tile_i0, R_)
+        ctx.save_for_backward(D, R)
+        # gamma and bandwidth are kept as Python scalars, reading them back from device tensors would sync every call
+        ctx.gamma = gamma
+        ctx.bandwidth = bandwidth
+        ctx.cache = cache
+
+        # The result is the cell diagonally before the one seeding the backward pass
+        r_end, c_end = _get_end_cell(N, M, bandwidth)
+        V = R[:, r_end - 1, c_end - 1]
+
+        # A recycled R is overwritten by the next call, so the result must not be a view of it
+        return V.clone() if reuse_R else V
 
     @staticmethod
     def backward(ctx, grad_output):
         dev = grad_output.device
         dtype = grad_output.dtype
-        D, R, gamma, bandwidth = ctx.saved_tensors
+        D, R = ctx.saved_tensors
+        gamma = ctx.gamma
+        bandwidth = ctx.bandwidth
 
         B = D.shape[0]
         N = D.shape[1]
         M = D.shape[2]
-        threads_per_block = max(N, M)
-        n_passes = 2 * threads_per_block - 1
+        tile = min(TILE_SIZE, max(N, M))
+        n_tile_diags = (N + tile - 1) // tile + (M + tile - 1) // tile - 1
 
-        D_ = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
+        # D_ and E are only used within this call, so they can always be recycled
+        D_ = _get_buffer(ctx.cache, 'D', (B, N + 2, M + 2), dev, dtype)
         D_[:, 1:N + 1, 1:M + 1] = D
-
-        # E = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
-        # E[:, -1, -1] = 1
-
-        l1 = D.shape[1]
-        l2 = D.shape[2]
-        bw = int(bandwidth.item())
-
-        # print(l1, l2, '---')
-
-        if l1 < l2:
-            if bw >= abs(l1 - l2) or bw == 0:
-                R[:, :, -1] = -math.inf
-                R[:, -1, :] = -math.inf
-                R[:, -1, -1] = R[:, -2, -2]
-                E = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
-                E[:, -1, -1] = 1
-
-            else:
-                R[:, :, l1 - l2 + int(bandwidth.item()) - 1] = -math.inf
-                R[:, -1, :] = -math.inf
-                R[:, -1, l1 - l2 + int(bandwidth.item()) - 1] = R[:, -2, l1 - l2 + int(bandwidth.item()) - 2]
-                E = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
-                E[:, -1, l1 - l2 + int(bandwidth.item()) - 1] = 1
-
-        elif l1 > l2:
-            if bw >= abs(l1 - l2) or bw == 0:
-                R[:, :, -1] = -math.inf
-                R[:, -1, :] = -math.inf
-                R[:, -1, -1] = R[:, -2, -2]
-                E = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
-                E[:, -1, -1] = 1
-
-            else:
-                R[:, :, -1] = -math.inf
-                R[:, l2 - l1 + int(bandwidth.item()) - 1, :] = -math.inf
-                R[:, l2 - l1 + int(bandwidth.item()) - 1, -1] = R[:, l2 - l1 + int(bandwidth.item()) - 2, -2]
-                E = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
-                E[:, l2 - l1 + int(bandwidth.item()) - 1, -1] = 1
-
-        else:
-            R[:, :, -1] = -math.inf
-            R[:, -1, :] = -math.inf
-            R[:, -1, -1] = R[:, -2, -2]
-            E = torch.zeros((B, N + 2, M + 2), dtype=dtype, device=dev)
-            E[:, -1, -1] = 1
-
-
-
-        # Grid and block sizes are set same as done above for the forward() call
-        compute_softdtw_backward_cuda[B, threads_per_block](cuda.as_cuda_array(D_),
-                                                            cuda.as_cuda_array(R),
-                                                            1.0 / gamma.item(), bandwidth.item(), N, M, n_passes,
-                                                            cuda.as_cuda_array(E))
+        D_[:, [0, -1], :] = 0
+        D_[:, :, [0, -1]] = 0
+        E = _get_buffer(ctx.cache, 'E', (B, N + 2, M + 2), dev, dtype)
+
+        # Seed the backward pass at the cell the forward pass ended on
+        D_ = cuda.as_cuda_array(D_)
+        R_ = cuda.as_cuda_array(R)
+        E_ = cuda.as_cuda_array(E)
+        stream = _get_stream(dev)
+        r_end, c_end = _get_end_cell(N, M, bandwidth)
+        n_threads = 256
+        n_elems = B * (N + 2) * (M + 2)
+        init_softdtw_backward_cuda[(n_elems + n_threads - 1) // n_threads, n_threads, stream](R_, r_end, c_end, E_)
+
+        # Grid and block sizes are set same as done above for the forward() call, the tiles are visited in reverse
+        kernel = _make_compute_softdtw_backward_cuda(tile, _get_shared_dtype(dtype), bandwidth > 0)
+        for tile_diag in range(n_tile_diags - 1, -1, -1):
+            tile_i0, tile_i1 = _get_tile_range(tile_diag, tile, N, M, bandwidth)
+            if tile_i0 > tile_i1:
+                continue
+            kernel[(B, tile_i1 - tile_i0 + 1), tile, stream](D_, R_, 1.0 / gamma, bandwidth, N, M,
+                                                              tile_diag, tile_i0, E_)
         E = E[:, 1:N + 1, 1:M + 1]
-        return grad_output.view(-1, 1, 1).expand_as(E) * E, None, None
+        return grad_output.view(-1, 1, 1).expand_as(E) * E, None, None, None
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -222,14 +430,53 @@ class _SoftDTWCUDA(Function):
 # I've added support for batching and pruning.
 #
 # ----------------------------------------------------------------------------------------------------------------------
-@jit(nopython=True)
+def _get_diagonal_rows(p, N, M, bandwidth):
+    """
+    Returns the rows of the cells [i, p - i] on anti-diagonal p that are within bounds and within the bandwidth
+    """
+    lo = max(1, p - M)
+    hi = min(N, p - 1)
+    if bandwidth > 0:
+        lo = max(lo, math.ceil((p - bandwidth) / 2))
+        hi = min(hi, math.floor((p + bandwidth) / 2))
+    return lo, hi
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_end_cell(N, M, bandwidth):
+    """
+    Returns the cell (in the padded R) that seeds the backward pass, the result of the forward pass is the cell
+    diagonally before it. Both passes end early when the bandwidth is too narrow to reach R[N, M].
+    """
+    bw = int(bandwidth)
+    if bw == 0 or bw >= abs(N - M):
+        return N + 1, M + 1
+    elif N < M:
+        return N + 1, N + bw + 1
+    else:
+        return M + bw + 1, M + 1
+
+
+# ----------------------------------------------------------------------------------------------------------------------
 def compute_softdtw(D, gamma, bandwidth):
     B = D.shape[0]
     N = D.shape[1]
     M = D.shape[2]
-    R = np.ones((B, N + 2, M + 2)) * np.inf
+    # The boundary is filled by NumPy, only the recursion itself is compiled
+    R = np.full((B, N + 2, M + 2), np.inf)
     R[:, 0, 0] = 0
-    for b in range(B):
+    _fill_R(D, R, gamma, bandwidth)
+    return R
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+@jit(nopython=True, parallel=True)
+def _fill_R(D, R, gamma, bandwidth):
+    B = D.shape[0]
+    N = D.shape[1]
+    M = D.shape[2]
+    # Every pair of examples is independent, so the batch is split across threads
+    for b in prange(B):
         for j in range(1, M + 1):
             for i in range(1, N + 1):
 
@@ -240,18 +487,19 @@ def compute_softdtw(D, gamma, bandwidth):
                 r0 = -R[b, i - 1, j - 1] / gamma
                 r1 = -R[b, i - 1, j] / gamma
                 r2 = -R[b, i, j - 1] / gamma
+                # exp(rmax - rmax) == 1, so only the two smaller terms need an exp
                 rmax = max(max(r0, r1), r2)
-                rsum = np.exp(r0 - rmax) + np.exp(r1 - rmax) + np.exp(r2 - rmax)
-                softmin = - gamma * (np.log(rsum) + rmax)
+                rmin = min(min(r0, r1), r2)
+                rmid = max(min(r0, r1), min(max(r0, r1), r2))
+                rsum = np.exp(rmid - rmax) + np.exp(rmin - rmax)
+                softmin = - gamma * (np.log1p(rsum) + rmax)
                 R[b, i, j] = D[b, i - 1, j - 1] + softmin
 
     # print('============', R)
     # print(D)
-    return R
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-@jit(nopython=True)
 def compute_softdtw_backward(D_, R, gamma, bandwidth):
     # print(D_.shape, R.shape)
 
@@ -261,54 +509,27 @@ def compute_softdtw_backward(D_, R, gamma, bandwidth):
     D = np.zeros((B, N + 2, M + 2))
     E = np.zeros((B, N + 2, M + 2))
     D[:, 1:N + 1, 1:M + 1] = D_
+    # Work on a copy, R may share its memory with the tensor saved by the forward pass
+    R = R.astype(np.float64)
 
-    l1 = D_.shape[1]
-    l2 = D_.shape[2]
-    bw = int(bandwidth.item())
-
-    # print(l1, l2, '---')
+    # The boundary is set up by NumPy, only the recursion itself is compiled
+    r_end, c_end = _get_end_cell(N, M, bandwidth)
+    E[:, r_end, c_end] = 1
+    R[:, :, c_end] = -np.inf
+    R[:, r_end, :] = -np.inf
+    R[:, r_end, c_end] = R[:, r_end - 1, c_end - 1]
+    _fill_E(D, R, E, gamma, bandwidth)
 
-    if l1 < l2:
-        if bw >= abs(l1 - l2) or bw == 0:
-            E[:, -1, -1] = 1
-            R[:, :, -1] = -np.inf
-            R[:, -1, :] = -np.inf
-
-            V = R[:, -2, -2]
-            R[:, -1, -1] = V # R[:, -2, -2]
-        else:
-            E[:, -1, l1 - l2 + int(bandwidth.item())-1] = 1
-            R[:, :, l1 - l2 + int(bandwidth.item())-1] = -np.inf
-            R[:, -1, :] = -np.inf
-
-            V = R[:, -2, l1 - l2 + int(bandwidth.item()) - 2]
-            R[:, -1, l1 - l2 + int(bandwidth.item())-1] = V
-
-    elif l1 > l2:
-        if bw >= abs(l1 - l2) or bw == 0:
-            E[:, -1, -1] = 1
-            R[:, :, -1] = -np.inf
-            R[:, -1, :] = -np.inf
-
-            V = R[:, -2, -2]
-            R[:, -1, -1] = R[:, -2, -2]
-        else:
-            E[:, l2 - l1 + int(bandwidth.item())-1, -1] = 1
-            R[:, :, -1] = -np.inf
-            R[:, l2 - l1 + int(bandwidth.item())-1, :] = -np.inf
-
-            V = R[:, l2 - l1 + int(bandwidth.item()) - 2, -2]
-            R[:, l2 - l1 + int(bandwidth.item())-1, -1] = V
-
-    else:
-        E[:, -1, -1] = 1
-        R[:, :, -1] = -np.inf
-        R[:, -1, :] = -np.inf
+    return E[:, 1:N + 1, 1:M + 1]
 
-        V = R[:, -2, -2]
-        R[:, -1, -1] = V # R[:, -2, -2]
 
-    for k in range(B):
+# ----------------------------------------------------------------------------------------------------------------------
+@jit(nopython=True, parallel=True)
+def _fill_E(D, R, E, gamma, bandwidth):
+    B = D.shape[0]
+    N = D.shape[1] - 2
+    M = D.shape[2] - 2
+    for k in prange(B):
         for j in range(M, 0, -1):
             for i in range(N, 0, -1):
 
@@ -327,6 +548,77 @@ def compute_softdtw_backward(D_, R, gamma, bandwidth):
                 c = np.exp(c0)
                 E[k, i, j] = E[k, i + 1, j] * a + E[k, i, j + 1] * b + E[k, i + 1, j + 1] * c
 
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+# The following is an on-device version of the CPU implementation above. It is used when the CUDA kernels are not
+# requested but the inputs live on the GPU: every anti-diagonal is updated at once with vectorized PyTorch ops, so the
+# data never leaves the device.
+#
+# ----------------------------------------------------------------------------------------------------------------------
+# Each anti-diagonal costs a dozen or so small PyTorch ops (kernel launches on the GPU), which dwarfs the round trip to
+# the CPU implementation for the short sequences used here. Only problems with at least this many cells of D stay on
+# the device.
+TORCH_SWEEP_MIN_CELLS = 1 << 22
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _use_torch_sweep(D):
+    """
+    Whether the on-device sweep should be used for D instead of copying it over to the CPU implementation
+    """
+    return D.is_cuda and D.shape[0] * D.shape[1] * D.shape[2] >= TORCH_SWEEP_MIN_CELLS
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def compute_softdtw_torch(D, gamma, bandwidth):
+    B = D.shape[0]
+    N = D.shape[1]
+    M = D.shape[2]
+    R = torch.full((B, N + 2, M + 2), math.inf, device=D.device, dtype=D.dtype)
+    R[:, 0, 0] = 0
+    for p in range(2, N + M + 1):
+        lo, hi = _get_diagonal_rows(p, N, M, bandwidth)
+        if lo > hi:
+            continue
+        i = torch.arange(lo, hi + 1, device=D.device)
+        j = p - i
+        r = torch.stack([R[:, i - 1, j - 1], R[:, i - 1, j], R[:, i, j - 1]]) / -gamma
+        softmin = -gamma * torch.logsumexp(r, dim=0)
+        R[:, i, j] = D[:, i - 1, j - 1] + softmin
+    return R
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def compute_softdtw_backward_torch(D_, R, gamma, bandwidth):
+    B = D_.shape[0]
+    N = D_.shape[1]
+    M = D_.shape[2]
+    D = torch.zeros((B, N + 2, M + 2), device=D_.device, dtype=D_.dtype)
+    E = torch.zeros((B, N + 2, M + 2), device=D_.device, dtype=D_.dtype)
+    D[:, 1:N + 1, 1:M + 1] = D_
+    R = R.clone()
+
+    r_end, c_end = _get_end_cell(N, M, bandwidth)
+    E[:, r_end, c_end] = 1
+    R[:, :, c_end] = -math.inf
+    R[:, r_end, :] = -math.inf
+    R[:, r_end, c_end] = R[:, r_end - 1, c_end - 1]
+    R_ = R[:, 1:N + 1, 1:M + 1]
+    R_.masked_fill_(torch.isinf(R_), -math.inf)
+
+    for p in range(N + M, 1, -1):
+        lo, hi = _get_diagonal_rows(p, N, M, bandwidth)
+        if lo > hi:
+            continue
+        i = torch.arange(lo, hi + 1, device=D_.device)
+        j = p - i
+        r = R[:, i, j]
+        a = torch.exp((R[:, i + 1, j] - r - D[:, i + 1, j]) / gamma)
+        b = torch.exp((R[:, i, j + 1] - r - D[:, i, j + 1]) / gamma)
+        c = torch.exp((R[:, i + 1, j + 1] - r - D[:, i + 1, j + 1]) / gamma)
+        E[:, i, j] = E[:, i + 1, j] * a + E[:, i, j + 1] * b + E[:, i + 1, j + 1] * c
+
     return E[:, 1:N + 1, 1:M + 1]
 
 
@@ -334,37 +626,26 @@ def compute_softdtw_backward(D_, R, gamma, bandwidth):
 class _SoftDTW(Function):
     """
     CPU implementation based on https://github.com/Sleepwalking/pytorch-softdtw
+    (large GPU inputs are handled by the on-device version of it)
     """
 
     @staticmethod
     def forward(ctx, D, gamma, bandwidth):
         dev = D.device
         dtype = D.dtype
-        gamma = torch.Tensor([gamma]).to(dev).type(dtype)  # dtype fixed
-        bandwidth = torch.Tensor([bandwidth]).to(dev).type(dtype)
-        D_ = D.detach().cpu().numpy()
-        g_ = gamma.item()
-        b_ = bandwidth.item()
-        R = torch.Tensor(compute_softdtw(D_, g_, b_)).to(dev).type(dtype)
-        ctx.save_for_backward(D, R, gamma, bandwidth)
-
-        l1 = D.shape[1]
-        l2 = D.shape[2]
-        bw = int(bandwidth.item())
-
-        if l1 < l2:
-            if bw >= abs(l1 - l2) or bw == 0:
-                V = R[:, -2, -2]
-            else:
-                V = R[:, -2, l1-l2+int(bandwidth.item())-2]
-        elif l1 > l2:
-            if bw >= abs(l1 - l2) or bw == 0:
-                V = R[:, -2, -2]
-            else:
-                V = R[:, l2-l1+int(bandwidth.item())-2, -2]
-
+        if _use_torch_sweep(D):
+            # No round trip through the host for large GPU inputs
+            R = compute_softdtw_torch(D.detach(), gamma, bandwidth)
         else:
-            V = R[:, -2, -2]
+            D_ = D.detach().cpu().numpy()
+            R = torch.Tensor(compute_softdtw(D_, gamma, bandwidth)).to(dev).type(dtype)
+        ctx.save_for_backward(D, R)
+        ctx.gamma = gamma
+        ctx.bandwidth = bandwidth
+
+        # The result is the cell diagonally before the one seeding the backward pass
+        r_end, c_end = _get_end_cell(D.shape[1], D.shape[2], bandwidth)
+        V = R[:, r_end - 1, c_end - 1]
 
         # return R[:, -2, -2]
         return V
@@ -373,12 +654,17 @@ class _SoftDTW(Function):
     def backward(ctx, grad_output):
         dev = grad_output.device
         dtype = grad_output.dtype
-        D, R, gamma, bandwidth = ctx.saved_tensors
-        D_ = D.detach().cpu().numpy()
-        R_ = R.detach().cpu().numpy()
-        g_ = gamma.item()
-        b_ = bandwidth.item()
-        E = torch.Tensor(compute_softdtw_backward(D_, R_, g_, b_)).to(dev).type(dtype)
+        D, R = ctx.saved_tensors
+        # Nothing flows back (e.g. a loss term that was masked out), skip the sweep. Only checked on the CPU, reading the
+        # flag back from the GPU would sync on every call, which costs more than it saves
+        if not grad_output.is_cuda and not grad_output.any():
+            return torch.zeros_like(D), None, None
+        if _use_torch_sweep(D):
+            E = compute_softdtw_backward_torch(D.detach(), R, ctx.gamma, ctx.bandwidth).type(dtype)
+        else:
+            D_ = D.detach().cpu().numpy()
+            R_ = R.detach().cpu().numpy()
+            E = torch.Tensor(compute_softdtw_backward(D_, R_, ctx.gamma, ctx.bandwidth)).to(dev).type(dtype)
 
         return grad_output.view(-1, 1, 1).expand_as(E) * E, None, None
 
@@ -403,6 +689,8 @@ class SoftDTW(torch.nn.Module):
         self.gamma = gamma
         self.bandwidth = 0 if bandwidth is None else float(bandwidth)
         self.use_cuda = use_cuda
+        # Work buffers of the CUDA implementation, recycled across calls (see _get_buffer())
+        self._cuda_cache = {}
 
     def _get_func_dtw(self, x, y):
         """
@@ -414,28 +702,22 @@ class SoftDTW(torch.nn.Module):
         assert bx == by  # Equal batch sizes
         assert dx == dy  # Equal feature dimensions
 
-        use_cuda = self.use_cuda
-
-        if use_cuda and (lx > 1024 or ly > 1024):  # We should be able to spawn enough threads in CUDA
-            print(
-                "SoftDTW: Cannot use CUDA because the sequence length > 1024 (the maximum block size supported by CUDA)")
-            use_cuda = False
-
         # Finally, return the correct function
-        return _SoftDTWCUDA.apply if use_cuda else _SoftDTW.apply
+        if self.use_cuda:
+            return lambda D, gamma, bandwidth: _SoftDTWCUDA.apply(D, gamma, bandwidth, self._cuda_cache)
+        return _SoftDTW.apply
 
     def _calc_distance_matrix(self, x, y):
         """
         Calculates the Euclidean distance between each element in x and y per timestep
         """
-        n = x.size(1)
-        m = y.size(1)
         d = x.size(2)
-        x = x.unsqueeze(2).expand(-1, n, m, d)
-        y = y.unsqueeze(1).expand(-1, n, m, d)
-        # RBF distance
+        # RBF distance, sum_d (2 - 2 * exp(-sigma * (x_d - y_d)^2)).
+        # The constant is pulled out of the sum and the element-wise ops are done in place, so only two
+        # batch x n x m x d temporaries are allocated (the kernel is applied per dimension, hence no bmm shortcut)
         sigma = 0.5
-        return (2 - 2 * torch.exp(-sigma * torch.pow(x - y, 2))).sum(3)
+        k = (x.unsqueeze(2) - y.unsqueeze(1)).pow(2).mul_(-sigma).exp_()
+        return 2 * d - 2 * k.sum(3)
         # return torch.pow(x - y, 2).sum(3)
 
     def forward(self, X, Y):
@@ -450,14 +732,21 @@ class SoftDTW(torch.nn.Module):
         func_dtw = self._get_func_dtw(X, Y)
 
         if self.normalize:
-            # Stack everything up and run
-            D_xy = self._calc_distance_matrix(X, Y)
-            D_xx = self._calc_distance_matrix(X, X)
-            D_yy = self._calc_distance_matrix(Y, Y)
+            if X.shape[1] == Y.shape[1]:
+                # Stack everything up and run, all three problems have the same shape so a single call solves them
+                x = torch.cat([X, X, Y])
+                y = torch.cat([Y, X, Y])
+                D = self._calc_distance_matrix(x, y)
+                out = func_dtw(D, self.gamma, self.bandwidth)
+                out_xy, out_xx, out_yy = torch.split(out, X.shape[0])
+            else:
+                D_xy = self._calc_distance_matrix(X, Y)
+                D_xx = self._calc_distance_matrix(X, X)
+                D_yy = self._calc_distance_matrix(Y, Y)
 
-            out_xy = func_dtw(D_xy, self.gamma, self.bandwidth)
-            out_xx = func_dtw(D_xx, self.gamma, self.bandwidth)
-            out_yy = func_dtw(D_yy, self.gamma, self.bandwidth)
+                out_xy = func_dtw(D_xy, self.gamma, self.bandwidth)
+                out_xx = func_dtw(D_xx, self.gamma, self.bandwidth)
+                out_yy = func_dtw(D_yy, self.gamma, self.bandwidth)
 
             return out_xy - 1 / 2 * (out_xx + out_yy)
         else: